@@ -0,0 +1,326 @@
+# agent_common.py
+# Gemeinsame Bausteine für dspy_agent.py und dspy_agent2.py
+import asyncio
+import json
+import re
+import textwrap
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Iterator, List, Union
+
+import dspy
+import httpx
+
+
+# =============================================================================
+# HTTP-Client pro Event-Loop
+# =============================================================================
+class PerLoopAsyncClient:
+    """
+    httpx.AsyncClient mit Keep-Alive, aber je Event-Loop ein eigener.
+
+    Gepoolte Verbindungen gehören zu dem Loop, in dem sie geöffnet wurden. Ein
+    Client auf Modulebene bricht deshalb ab, sobald ein zweites asyncio.run
+    (z.B. ein weiterer synchroner agent(...)-Aufruf) ihn benutzt.
+    """
+
+    def __init__(self, **kwargs: Any):
+        self._kwargs = kwargs
+        self._clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient]" = weakref.WeakKeyDictionary()
+
+    def _current(self) -> httpx.AsyncClient:
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None:
+            client = self._clients[loop] = httpx.AsyncClient(**self._kwargs)
+        return client
+
+    async def post(self, url: str, **kwargs: Any) -> httpx.Response:
+        return await self._current().post(url, **kwargs)
+
+    async def aclose(self) -> None:
+        """Schließe den Client des laufenden Loops."""
+        client = self._clients.pop(asyncio.get_running_loop(), None)
+        if client is not None:
+            await client.aclose()
+
+
+# =============================================================================
+# Agent-Events (werden während des Laufs gestreamt)
+# =============================================================================
+@dataclass
+class TextDelta:
+    """Begründung des Modells aus einem Schritt (kann leer sein)."""
+    text: str
+
+
+@dataclass
+class ToolCallDone:
+    """Ein ausgeführter Tool-Aufruf samt Ergebnis."""
+    tool_name: str
+    tool_args: dict
+    observation: Any
+
+
+@dataclass
+class FinalAnswer:
+    text: str
+
+
+AgentEvent = Union[TextDelta, ToolCallDone, FinalAnswer]
+
+
+# =============================================================================
+# Trajectory-Schritte (Format von dspy.ReAct: thought_i, tool_name_i, ...)
+# =============================================================================
+@dataclass(slots=True)
+class Step:
+    thought: str
+    tool_name: str
+    tool_args: dict
+    observation: Any
+
+
+def iter_react_steps(trajectory: dict) -> Iterator[Step]:
+    """Liefere die Schritte einer Trajectory in Reihenfolge (ein Durchlauf über die Keys)."""
+    indices = sorted(int(k.removeprefix("tool_name_")) for k in trajectory if k.startswith("tool_name_"))
+    for i in indices:
+        yield Step(
+            trajectory.get(f"thought_{i}", ""),
+            trajectory[f"tool_name_{i}"],
+            trajectory.get(f"tool_args_{i}", {}),
+            trajectory.get(f"observation_{i}", ""),
+        )
+
+
+# =============================================================================
+# ReAct mit nativem Tool-Calling (ein LLM-Aufruf pro Schritt)
+# =============================================================================
+class SingleTurnReAct(dspy.Module):
+    """
+    ReAct-Variante mit nur EINEM LLM-Aufruf pro Schritt.
+
+    dspy.ReAct fragt das Modell pro Iteration getrennt nach Thought und Action.
+    Hier nutzen wir natives Tool-Calling: das Modell liefert seine Begründung
+    (message.content) und den Tool-Aufruf (message.tool_calls) in derselben Antwort.
+    Die Trajectory hat dasselbe Format wie bei dspy.ReAct (thought_i, tool_name_i, ...).
+    """
+
+    def __init__(self, signature, tools: List[Any], max_iters: int = 6):
+        super().__init__()
+        self.signature = dspy.ensure_signature(signature)
+        tools = [t if isinstance(t, dspy.Tool) else dspy.Tool(t) for t in tools]
+        self.tools = {t.name: t for t in tools}
+        self.max_iters = max_iters
+        self.output_name = next(iter(self.signature.output_fields))
+        # Tool-Spezifikation und System-Prompt sind pro Agent konstant -> einmal bauen.
+        # Gleicher Prompt-Anfang bei jedem Aufruf = Prefix-Cache-Treffer im LLM-Server.
+        self._tools = [self._to_openai_tool(t) for t in tools]
+        self._system_message = {"role": "system", "content": self._system_prompt()}
+
+    @staticmethod
+    def _to_openai_tool(tool: dspy.Tool) -> dict:
+        """dspy.Tool -> OpenAI/LiteLLM Tool-Spezifikation."""
+        required = [name for name, schema in tool.args.items() if "default" not in schema]
+        return {
+            "type": "function",
+            "function": {
+                "name": tool.name,
+                "description": tool.desc or "",
+                "parameters": {"type": "object", "properties": tool.args, "required": required},
+            },
+        }
+
+    def _system_prompt(self) -> str:
+        output_desc = self.signature.output_fields[self.output_name].json_schema_extra["desc"]
+        return (
+            f"{self.signature.instructions}\n\n"
+            f"When you are done, answer WITHOUT calling a tool. Your answer: {output_desc}"
+        )
+
+    def _user_prompt(self, inputs: dict) -> str:
+        return "\n".join(f"{name}: {inputs[name]}" for name in self.signature.input_fields)
+
+    async def _call_tool(self, name: str, arguments: str) -> tuple[dict, Any]:
+        """Führe einen Tool-Call aus. Gibt (args, observation) zurück."""
+        try:
+            args = json.loads(arguments or "{}")
+        except json.JSONDecodeError as e:
+            return {}, {"error": f"invalid tool arguments: {e}"}
+
+        tool = self.tools.get(name)
+        if tool is None:
+            return args, {"error": f"unknown tool: {name}"}
+        try:
+            return args, await tool.acall(**args)
+        except Exception as e:
+            return args, {"error": str(e)}
+
+    def forward(self, **kwargs):
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(self.aforward(**kwargs))
+        # Aufruf aus einem laufenden Loop (z.B. Notebook): eigener Loop in einem Worker-Thread
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            return pool.submit(asyncio.run, self.aforward(**kwargs)).result()
+
+    async def aforward(self, **kwargs):
+        trajectory = {}
+        step = 0
+        thought = ""
+        answer = ""
+
+        async for event in self.astream(**kwargs):
+            if isinstance(event, TextDelta):
+                thought = event.text
+            elif isinstance(event, ToolCallDone):
+                trajectory[f"thought_{step}"] = thought
+                trajectory[f"tool_name_{step}"] = event.tool_name
+                trajectory[f"tool_args_{step}"] = event.tool_args
+                trajectory[f"observation_{step}"] = event.observation
+                step += 1
+            else:
+                answer = event.text
+
+        return dspy.Prediction(trajectory=trajectory, **{self.output_name: answer})
+
+    async def astream(self, **kwargs) -> AsyncIterator[AgentEvent]:
+        """Führe den Agenten aus und liefere Events, sobald sie entstehen."""
+        lm = dspy.settings.lm
+        if lm is None:
+            raise ValueError("No LM configured. Call dspy.configure(lm=...) first.")
+
+        messages = [self._system_message, {"role": "user", "content": self._user_prompt(kwargs)}]
+
+        for _ in range(self.max_iters):
+            response = await lm.aforward(messages=messages, tools=self._tools, tool_choice="auto")
+            message = response.choices[0].message
+
+            # Kein Tool-Call mehr -> message.content ist die finale Antwort
+            if not message.tool_calls:
+                yield FinalAnswer(message.content or "")
+                return
+
+            yield TextDelta(message.content or "")
+            messages.append({
+                "role": "assistant",
+                "content": message.content,
+                "tool_calls": [
+                    {"id": tc.id, "type": "function", "function": {"name": tc.function.name, "arguments": tc.function.arguments}}
+                    for tc in message.tool_calls
+                ],
+            })
+
+            # Mehrere Tool-Calls einer Antwort sind voneinander unabhängig -> gleichzeitig ausführen
+            results = await asyncio.gather(
+                *(self._call_tool(tc.function.name, tc.function.arguments) for tc in message.tool_calls)
+            )
+            for tc, (args, observation) in zip(message.tool_calls, results):
+                yield ToolCallDone(tc.function.name, args, observation)
+
+                messages.append({
+                    "role": "tool",
+                    "tool_call_id": tc.id,
+                    "content": json.dumps(observation, ensure_ascii=False, default=str),
+                })
+
+        # max_iters erreicht -> Antwort ohne weitere Tool-Calls erzwingen
+        response = await lm.aforward(messages=messages, tools=self._tools, tool_choice="none")
+        yield FinalAnswer(response.choices[0].message.content or "")
+
+
+# =============================================================================
+# Mehrere Sendungen parallel bearbeiten
+# =============================================================================
+class SplitShipmentsSignature(dspy.Signature):
+    """
+    Split a shipping request into one self-contained request per shipment.
+    Keep destination (country, city), weight and service of each shipment together.
+    If there is only one shipment, return the request unchanged as the only item.
+    """
+    user_request: str = dspy.InputField(desc="The user's shipping request")
+    shipments: list[str] = dspy.OutputField(desc="One request per shipment")
+
+
+_split_shipments = dspy.Predict(SplitShipmentsSignature)
+
+# Günstige Vorprüfung: erst ab zwei Gewichtsangaben lohnt sich der Split-Aufruf
+_WEIGHT_RE = re.compile(r"\d+(?:[.,]\d+)?\s*kg", re.IGNORECASE)
+
+
+async def split_shipments(user_request: str) -> List[str]:
+    """Zerlege eine Anfrage in Einzelsendungen (nur wenn mehr als eine Gewichtsangabe vorkommt)."""
+    if len(_WEIGHT_RE.findall(user_request)) < 2:
+        return [user_request]
+    split = await _split_shipments.acall(user_request=user_request)
+    return [s for s in split.shipments if s.strip()] or [user_request]
+
+
+async def stream_many(agent: dspy.Module, user_request: str) -> AsyncIterator[AgentEvent]:
+    """
+    Bearbeite unabhängige Sendungen einer Anfrage parallel, als Event-Stream.
+
+    Eine Anfrage mit nur einer Sendung geht direkt an den Agenten. Sonst zerlegt
+    ein kurzer Predict-Aufruf die Anfrage in Einzelsendungen, deren Agent-Läufe
+    gleichzeitig laufen (LLM-Decoding und Tool-I/O überlappen). Die Events werden
+    geliefert, sobald sie entstehen; am Ende folgt EINE zusammengefasste FinalAnswer.
+    """
+    shipments = await split_shipments(user_request)
+    if len(shipments) == 1:
+        async for event in agent.astream(user_request=shipments[0]):
+            yield event
+        return
+
+    queue: asyncio.Queue = asyncio.Queue()
+
+    async def pump(idx: int, shipment: str) -> None:
+        try:
+            async for event in agent.astream(user_request=shipment):
+                await queue.put((idx, event))
+        finally:
+            await queue.put((idx, None))  # Lauf beendet
+
+    tasks = [asyncio.create_task(pump(i, s)) for i, s in enumerate(shipments)]
+    answers = [""] * len(shipments)
+    running = len(tasks)
+    while running:
+        idx, event = await queue.get()
+        if event is None:
+            running -= 1
+        elif isinstance(event, FinalAnswer):
+            answers[idx] = event.text
+        else:
+            yield event
+
+    await asyncio.gather(*tasks)  # Fehler einzelner Läufe weiterreichen
+    yield FinalAnswer("\n".join(answers))
+
+
+def _shorten(value: Any, width: int = 100) -> str:
+    return textwrap.shorten(str(value), width=width, placeholder="...")
+
+
+def print_step(step: Step) -> None:
+    """Kompakte Ausgabe eines Schritts: Thought, Tool-Aufruf, Ergebnis."""
+    if step.thought:
+        print(f"  Thought: {_shorten(step.thought)}")
+    if step.tool_name:
+        if isinstance(step.tool_args, dict):
+            args_str = ", ".join(f"{k}={v!r}" for k, v in step.tool_args.items())
+        else:
+            args_str = str(step.tool_args)
+        print(f"  -> {step.tool_name}({args_str})")
+    if step.observation:
+        print(f"  <- {_shorten(step.observation)}")
+
+
+def print_event(event: AgentEvent) -> None:
+    """Kompakte Live-Ausgabe eines Agent-Events."""
+    if isinstance(event, TextDelta):
+        print_step(Step(event.text, "", {}, ""))
+    elif isinstance(event, ToolCallDone):
+        print_step(Step("", event.tool_name, event.tool_args, event.observation))
+    else:
+        print(f"\n=> Final Answer: {event.text}")
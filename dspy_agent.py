@@ -1,20 +1,51 @@
 # dspy_agent.py
 # Minimaler, sauberer DSPy ReAct Agent
+import asyncio
+
 import dspy
-import requests
+import httpx
 from pydantic import BaseModel, Field
 from typing import Literal, Optional
 
+from agent_common import PerLoopAsyncClient, SingleTurnReAct, print_event, stream_many
+
 # =============================================================================
 # Konfiguration
 # =============================================================================
 OPENAPI_BASE = "http://localhost:9000"
 
+# Ein gemeinsamer Client für alle Tool-Aufrufe: Keep-Alive + Connection-Pooling,
+# damit nicht jeder Aufruf eine neue TCP-Verbindung aufbaut (je Event-Loop einer).
+_client = PerLoopAsyncClient(
+    base_url=OPENAPI_BASE,
+    timeout=10,
+    limits=httpx.Limits(max_connections=16, max_keepalive_connections=16),
+)
+
+# Prozesslokaler Cache für die Resolver-Tools. Die Resolver-Endpunkte sind
+# deterministisch (feste Alias-/Städte-Tabellen), wiederholte Anfragen wie
+# "Deutschland" -> "DE" sparen sich so den HTTP-Roundtrip.
+_RESOLVER_CACHE_SIZE = 1024
+_resolver_cache: dict[tuple, dict] = {}
+
+
+async def _cached_post(key: tuple, path: str, payload: dict) -> dict:
+    cached = _resolver_cache.get(key)
+    if cached is not None:
+        return dict(cached)  # Kopie, damit Aufrufer den Cache nicht verändern
+    r = await _client.post(path, json=payload)
+    result = r.json()
+    if r.status_code == 200:
+        if len(_resolver_cache) >= _RESOLVER_CACHE_SIZE:
+            del _resolver_cache[next(iter(_resolver_cache))]  # ältesten Eintrag verwerfen
+        _resolver_cache[key] = result
+    return dict(result)
+
 
 # =============================================================================
 # Tool-Funktionen (echte Python-Funktionen, die DSPy versteht)
 # =============================================================================
-def resolve_country(name: str) -> dict:
+async def resolve_country(name: str) -> dict:
     """
     Convert a country NAME to ISO2 code.
     Use this when you have a country name like 'Germany', 'Deutschland', 'France'.
@@ -26,11 +57,15 @@ def resolve_country(name: str) -> dict:
     Returns:
         dict with 'iso2' (the 2-letter code) or 'error' if not found
     """
-    r = requests.post(f"{OPENAPI_BASE}/v1/resolve/country", json={"name": name}, timeout=10)
-    return r.json()
+    # Modelle rufen das Tool trotzdem oft mit einem ISO2-Code auf -> ohne HTTP beantworten
+    code = name.strip()
+    if len(code) == 2 and code.isalpha():
+        return {"iso2": code.upper(), "confidence": 1.0, "trace_id": "local"}
+    key = ("resolve_country", name.strip().lower())
+    return await _cached_post(key, "/v1/resolve/country", {"name": name})
 
 
-def resolve_postal_code(mode: str, country: str, city: str = None, value: str = None) -> dict:
+async def resolve_postal_code(mode: str, country: str, city: str = None, value: str = None) -> dict:
     """
     Look up a postal code for a city, or validate an existing postal code.
     
@@ -48,11 +83,29 @@ def resolve_postal_code(mode: str, country: str, city: str = None, value: str =
         payload["city"] = city
     if value:
         payload["value"] = value
-    r = requests.post(f"{OPENAPI_BASE}/v1/resolve/postal", json=payload, timeout=10)
-    return r.json()
+    key = ("resolve_postal_code", mode, (country or "").strip().upper(), (city or "").strip().lower(), value or "")
+    return await _cached_post(key, "/v1/resolve/postal", payload)
+
+
+async def resolve_batch(items: list[dict]) -> list[dict]:
+    """
+    Run several resolver lookups in ONE call. Prefer this over single resolver calls
+    when the request contains more than one shipment.
+    
+    Args:
+        items: List of lookups, each {"tool": "resolve_country" or "resolve_postal_code", "args": {...}},
+               e.g. [{"tool": "resolve_country", "args": {"name": "Deutschland"}},
+                     {"tool": "resolve_country", "args": {"name": "Österreich"}}]
+    
+    Returns:
+        list of results in the same order as items
+    """
+    r = await _client.post("/v1/resolve/batch", json={"requests": items})
+    data = r.json()
+    return data["results"] if r.status_code == 200 else [data]
 
 
-def get_shipping_quote(country: str, postal_code: str, weight_kg: float, service: str = "standard") -> dict:
+async def get_shipping_quote(country: str, postal_code: str, weight_kg: float, service: str = "standard") -> dict:
     """
     Calculate shipping quote. This is the FINAL step after you have ISO2 country and postal code.
     
@@ -65,10 +118,9 @@ def get_shipping_quote(country: str, postal_code: str, weight_kg: float, service
     Returns:
         dict with 'price', 'currency', and 'service'
     """
-    r = requests.post(
-        f"{OPENAPI_BASE}/v1/shipping/quote",
+    r = await _client.post(
+        "/v1/shipping/quote",
         json={"country": country, "postal_code": postal_code, "weight_kg": weight_kg, "service": service},
-        timeout=10,
     )
     return r.json()
 
@@ -83,11 +135,14 @@ class ShippingQuoteSignature(dspy.Signature):
     WORKFLOW:
     1. If you see a country NAME (like "Germany", "Deutschland") -> call resolve_country to get ISO2 code
     2. If you have ISO2 but no postal code -> call resolve_postal_code(mode="lookup_city", country="DE", city="Berlin")
+       For MORE THAN ONE shipment use resolve_batch instead of steps 1-2: one call with all
+       resolve_country lookups, then one call with all resolve_postal_code lookups.
     3. Once you have ISO2 country AND postal code -> call get_shipping_quote
 
     RULES:
     - Do NOT guess postal codes or country codes. Use resolver tools first.
-    - For multiple shipments, process them step by step.
+    - Tool calls that do not depend on each other's results (e.g. several get_shipping_quote calls)
+      may be emitted together in one message.
     - Always use the VALUES from previous tool results (e.g., if resolve_country returned "DE", use country="DE").
     - You have at most 3 rounds to produce at least one successful get_shipping_quote call.
     """
@@ -98,7 +153,7 @@ class ShippingQuoteSignature(dspy.Signature):
 # =============================================================================
 # Runner
 # =============================================================================
-if __name__ == "__main__":
+async def main() -> None:
     # LM konfigurieren
     lm = dspy.LM(
         model="openai/meta-llama/Llama-3.1-8B-Instruct",
@@ -107,9 +162,11 @@ if __name__ == "__main__":
     )
     dspy.configure(lm=lm)
     
-    agent = dspy.ReAct(
+    # Die Tools sind Coroutinen -> der Agent wird mit acall() asynchron ausgeführt.
+    # SingleTurnReAct: Thought + Tool-Call in EINEM LLM-Aufruf pro Schritt.
+    agent = SingleTurnReAct(
         ShippingQuoteSignature,
-        tools=[resolve_country, resolve_postal_code, get_shipping_quote],
+        tools=[resolve_country, resolve_postal_code, resolve_batch, get_shipping_quote],
         max_iters=6,
     )
 
@@ -126,52 +183,9 @@ if __name__ == "__main__":
         print("=" * 60)
         
         try:
-            result = agent(user_request=t)
-            
-            # Zeige die Trajectory
-            trajectory = getattr(result, 'trajectory', None)
-            
-            if trajectory and isinstance(trajectory, dict):
-                # Trajectory ist ein Dict mit Keys wie thought_0, tool_name_0, etc.
-                i = 0
-                while True:
-                    thought_key = f"thought_{i}"
-                    tool_name_key = f"tool_name_{i}"
-                    tool_args_key = f"tool_args_{i}"
-                    obs_key = f"observation_{i}"
-                    
-                    if tool_name_key not in trajectory:
-                        break
-                    
-                    thought = trajectory.get(thought_key, "")
-                    tool_name = trajectory.get(tool_name_key, "")
-                    tool_args = trajectory.get(tool_args_key, {})
-                    observation = trajectory.get(obs_key, "")
-                    
-                    # Kompakte Ausgabe
-                    if thought:
-                        t_str = str(thought)[:100] + "..." if len(str(thought)) > 100 else str(thought)
-                        print(f"  Thought: {t_str}")
-                    
-                    if tool_name:
-                        if isinstance(tool_args, dict):
-                            args_str = ", ".join(f"{k}={v!r}" for k, v in tool_args.items())
-                        else:
-                            args_str = str(tool_args)
-                        print(f"  -> {tool_name}({args_str})")
-                    
-                    if observation:
-                        obs_str = str(observation)[:100] + "..." if len(str(observation)) > 100 else str(observation)
-                        print(f"  <- {obs_str}")
-                    
-                    i += 1
-                    
-            elif trajectory:
-                print(f"  [Debug] Trajectory: {trajectory}")
-            else:
-                print("  [Debug] No trajectory found")
-            
-            print(f"\n=> Final Answer: {result.final_answer}")
+            # Events live ausgeben, sobald sie entstehen
+            async for event in stream_many(agent, t):
+                print_event(event)
             
         except Exception as e:
             import traceback
@@ -179,3 +193,10 @@ if __name__ == "__main__":
             traceback.print_exc()
         
         print("-" * 60)
+
+    # Keep-Alive-Verbindungen des Pools sauber schließen
+    await _client.aclose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,38 +1,59 @@
 # dspy_agent2.py
 # DSPy Agent mit automatischer Tool-Generierung aus OpenAPI Spec
+import asyncio
+import functools
+import os
+
 import dspy
-import requests
-from typing import Any, Dict, List, Callable
+import httpx
+from typing import Any, Dict, List, Callable, Tuple, Type
+
+from pydantic import BaseModel
+
+from openapi_spec import fetch_openapi_spec
+from agent_common import PerLoopAsyncClient, SingleTurnReAct, iter_react_steps, print_event, print_step, stream_many
+
+
+# Gemeinsamer Client für alle generierten Tools (Keep-Alive + Connection-Pooling, je Event-Loop einer)
+_client = PerLoopAsyncClient(timeout=10, limits=httpx.Limits(max_connections=16, max_keepalive_connections=16))
+
+# Deterministische Endpunkte, deren Ergebnisse prozesslokal gecacht werden dürfen
+CACHEABLE_OPERATIONS = {"resolve_country", "resolve_postal_code"}
+
+# Opt-in: Tools aus den Pydantic-Modellen von main.py statt aus der OpenAPI Spec bauen
+# (nur sinnvoll, wenn Client und Server im selben Projekt liegen)
+TOOLS_FROM_MODELS = os.environ.get("DSPY_TOOLS_FROM_MODELS") == "1"
 
 
 # =============================================================================
 # OpenAPI -> DSPy Tools Konvertierung
 # =============================================================================
-def fetch_openapi_spec(base_url: str) -> dict:
-    """Lade OpenAPI Spec vom Server."""
-    r = requests.get(f"{base_url}/openapi.json", timeout=10)
-    r.raise_for_status()
-    return r.json()
-
-
-def resolve_schema_ref(spec: dict, schema: dict) -> dict:
-    """Löse $ref Referenzen in OpenAPI Schema auf."""
-    if "$ref" in schema:
-        ref_path = schema["$ref"]  # z.B. "#/components/schemas/ShippingQuoteRequest"
-        parts = ref_path.split("/")
+def make_ref_resolver(spec: dict) -> Callable[[dict], dict]:
+    """Erstelle einen $ref-Resolver für eine Spec. Jede Referenz wird nur einmal aufgelöst."""
+    
+    @functools.lru_cache(maxsize=None)
+    def lookup(ref_path: str) -> dict:
+        # z.B. "#/components/schemas/ShippingQuoteRequest"
         resolved = spec
-        for part in parts[1:]:  # Skip '#'
+        for part in ref_path.split("/")[1:]:  # Skip '#'
             resolved = resolved[part]
         return resolved
-    return schema
+    
+    def resolve_schema_ref(schema: dict) -> dict:
+        """Löse $ref Referenzen in OpenAPI Schema auf."""
+        if "$ref" in schema:
+            return lookup(schema["$ref"])
+        return schema
+    
+    return resolve_schema_ref
 
 
-def extract_args_from_schema(spec: dict, schema: dict) -> tuple[dict, dict]:
+def extract_args_from_schema(resolve_schema_ref: Callable[[dict], dict], schema: dict) -> tuple[dict, dict]:
     """
     Extrahiere args und arg_desc aus OpenAPI Schema.
     Returns: (args_dict, arg_desc_dict)
     """
-    resolved = resolve_schema_ref(spec, schema)
+    resolved = resolve_schema_ref(schema)
     properties = resolved.get("properties", {})
     required = resolved.get("required", [])
     
@@ -49,9 +70,11 @@ def extract_args_from_schema(spec: dict, schema: dict) -> tuple[dict, dict]:
         if "enum" in prop_schema:
             arg_schema["enum"] = prop_schema["enum"]
         
-        # Default handling
+        # Default handling (optionale Felder ohne Default -> None, sonst gelten sie als Pflicht)
         if "default" in prop_schema:
             arg_schema["default"] = prop_schema["default"]
+        elif prop_name not in required:
+            arg_schema["default"] = None
         
         args[prop_name] = arg_schema
         
@@ -65,18 +88,40 @@ def extract_args_from_schema(spec: dict, schema: dict) -> tuple[dict, dict]:
 
 
 def create_tool_function(base_url: str, path: str, operation_id: str) -> Callable:
-    """Erstelle eine Tool-Funktion für einen API-Endpunkt."""
+    """Erstelle eine (async) Tool-Funktion für einen API-Endpunkt."""
+    url = f"{base_url}{path}"
+    cache = {} if operation_id in CACHEABLE_OPERATIONS else None
     
-    def tool_func(**kwargs) -> dict:
+    async def tool_func(**kwargs) -> dict:
         # Entferne None-Werte
         payload = {k: v for k, v in kwargs.items() if v is not None}
-        r = requests.post(f"{base_url}{path}", json=payload, timeout=10)
-        return r.json()
+        key = tuple(sorted(payload.items()))
+        if cache is not None and key in cache:
+            return dict(cache[key])
+        r = await _client.post(url, json=payload)
+        result = r.json()
+        if cache is not None and r.status_code == 200:
+            cache[key] = result
+        return dict(result)
     
+    if operation_id == "resolve_country":
+        tool_func = _with_iso2_shortcut(tool_func)
     tool_func.__name__ = operation_id
     return tool_func
 
 
+def _with_iso2_shortcut(tool_func: Callable) -> Callable:
+    """Beantworte resolve_country lokal, wenn schon ein ISO2-Code übergeben wird."""
+    @functools.wraps(tool_func)
+    async def wrapper(**kwargs) -> dict:
+        code = (kwargs.get("name") or "").strip()
+        if len(code) == 2 and code.isalpha():
+            return {"iso2": code.upper(), "confidence": 1.0, "trace_id": "local"}
+        return await tool_func(**kwargs)
+    
+    return wrapper
+
+
 def create_tools_from_openapi(base_url: str, include_operations: List[str] = None) -> List[dspy.Tool]:
     """
     Erstelle DSPy Tools aus OpenAPI Spec.
@@ -89,6 +134,7 @@ def create_tools_from_openapi(base_url: str, include_operations: List[str] = Non
         Liste von dspy.Tool Objekten
     """
     spec = fetch_openapi_spec(base_url)
+    resolve_schema_ref = make_ref_resolver(spec)
     tools = []
     
     for path, methods in spec.get("paths", {}).items():
@@ -114,7 +160,7 @@ def create_tools_from_openapi(base_url: str, include_operations: List[str] = Non
             content = request_body.get("content", {}).get("application/json", {})
             schema = content.get("schema", {})
             
-            args, arg_desc = extract_args_from_schema(spec, schema)
+            args, arg_desc = extract_args_from_schema(resolve_schema_ref, schema)
             
             # Tool-Funktion erstellen
             func = create_tool_function(base_url, path, operation_id)
@@ -137,6 +183,62 @@ def create_tools_from_openapi(base_url: str, include_operations: List[str] = Non
     return tools
 
 
+def tools_from_models(base_url: str, models: Dict[str, Tuple[str, Type[BaseModel]]]) -> List[dspy.Tool]:
+    """
+    Erstelle DSPy Tools direkt aus den Pydantic Request-Modellen des Servers.
+    
+    Spart Spec-Download und $ref-Auflösung über die ganze Spec, wenn die Modelle
+    importierbar sind (Client und Server im selben Projekt).
+    
+    Args:
+        base_url: Basis-URL des API-Servers
+        models: operationId -> (Pfad, Request-Modell)
+    
+    Returns:
+        Liste von dspy.Tool Objekten
+    """
+    tools = []
+    
+    for operation_id, (path, model) in models.items():
+        schema = model.model_json_schema(ref_template="#/$defs/{model}")
+        # Verschachtelte Modelle liegen unter $defs im selben Schema
+        args, arg_desc = extract_args_from_schema(make_ref_resolver(schema), schema)
+        full_desc = schema.get("description", "")
+        
+        func = create_tool_function(base_url, path, operation_id)
+        func.__doc__ = full_desc
+        
+        tools.append(dspy.Tool(func=func, name=operation_id, desc=full_desc, args=args, arg_desc=arg_desc))
+        print(f"  Created tool: {operation_id} ({path})")
+    
+    return tools
+
+
+def load_tools(base_url: str, from_models: bool = TOOLS_FROM_MODELS) -> List[dspy.Tool]:
+    """
+    Tools standardmäßig aus der OpenAPI Spec laden.
+
+    Mit from_models (bzw. DSPY_TOOLS_FROM_MODELS=1) werden die Request-Modelle aus
+    main.py importiert; die Tool-Beschreibungen stammen dann aus deren Docstrings.
+    """
+    if from_models:
+        try:
+            from main import ResolveCountryRequest, ResolvePostalRequest, ShippingQuoteRequest
+        except ImportError:
+            pass
+        else:
+            return tools_from_models(base_url, {
+                "resolve_country": ("/v1/resolve/country", ResolveCountryRequest),
+                "resolve_postal_code": ("/v1/resolve/postal", ResolvePostalRequest),
+                "get_shipping_quote": ("/v1/shipping/quote", ShippingQuoteRequest),
+            })
+    
+    return create_tools_from_openapi(
+        base_url,
+        include_operations=["resolve_country", "resolve_postal_code", "get_shipping_quote"]
+    )
+
+
 # =============================================================================
 # DSPy Agent
 # =============================================================================
@@ -151,7 +253,8 @@ class ShippingQuoteSignature(dspy.Signature):
 
     RULES:
     - Do NOT guess postal codes or country codes. Use resolver tools first.
-    - For multiple shipments, process them step by step.
+    - Tool calls that do not depend on each other's results (e.g. several get_shipping_quote calls)
+      may be emitted together in one message.
     - Always use the VALUES from previous tool results (e.g., if resolve_country returned "DE", use country="DE").
     - You have at most 3 rounds to produce at least one successful get_shipping_quote call.
     """
@@ -162,7 +265,7 @@ class ShippingQuoteSignature(dspy.Signature):
 class OpenAPIAgent(dspy.Module):
     def __init__(self, tools: List[dspy.Tool], max_iters: int = 6):
         super().__init__()
-        self.agent = dspy.ReAct(
+        self.agent = SingleTurnReAct(
             ShippingQuoteSignature,
             tools=tools,
             max_iters=max_iters,
@@ -171,52 +274,29 @@ class OpenAPIAgent(dspy.Module):
     def forward(self, user_request: str):
         return self.agent(user_request=user_request)
 
+    async def aforward(self, user_request: str):
+        return await self.agent.acall(user_request=user_request)
+
+    def astream(self, user_request: str):
+        return self.agent.astream(user_request=user_request)
+
 
 # =============================================================================
 # Kompakte Ausgabe
 # =============================================================================
 def print_trajectory(result) -> None:
-    """Zeige die Tool-Aufrufe im kompakten Format."""
+    """Zeige die Tool-Aufrufe eines fertigen Ergebnisses im kompakten Format (ohne Streaming)."""
     trajectory = getattr(result, 'trajectory', None)
     
     if trajectory and isinstance(trajectory, dict):
-        i = 0
-        while True:
-            thought_key = f"thought_{i}"
-            tool_name_key = f"tool_name_{i}"
-            tool_args_key = f"tool_args_{i}"
-            obs_key = f"observation_{i}"
-            
-            if tool_name_key not in trajectory:
-                break
-            
-            thought = trajectory.get(thought_key, "")
-            tool_name = trajectory.get(tool_name_key, "")
-            tool_args = trajectory.get(tool_args_key, {})
-            observation = trajectory.get(obs_key, "")
-            
-            if thought:
-                t_str = str(thought)[:100] + "..." if len(str(thought)) > 100 else str(thought)
-                print(f"  Thought: {t_str}")
-            
-            if tool_name:
-                if isinstance(tool_args, dict):
-                    args_str = ", ".join(f"{k}={v!r}" for k, v in tool_args.items())
-                else:
-                    args_str = str(tool_args)
-                print(f"  -> {tool_name}({args_str})")
-            
-            if observation:
-                obs_str = str(observation)[:100] + "..." if len(str(observation)) > 100 else str(observation)
-                print(f"  <- {obs_str}")
-            
-            i += 1
+        for step in iter_react_steps(trajectory):
+            print_step(step)
 
 
 # =============================================================================
 # Main
 # =============================================================================
-if __name__ == "__main__":
+async def main() -> None:
     OPENAPI_BASE = "http://localhost:9000"
     
     # LM konfigurieren
@@ -227,12 +307,9 @@ if __name__ == "__main__":
     )
     dspy.configure(lm=lm)
     
-    # Tools aus OpenAPI generieren
-    print("Loading tools from OpenAPI spec...")
-    tools = create_tools_from_openapi(
-        OPENAPI_BASE,
-        include_operations=["resolve_country", "resolve_postal_code", "get_shipping_quote"]
-    )
+    # Tools aus der OpenAPI Spec generieren (DSPY_TOOLS_FROM_MODELS=1: aus den Request-Modellen)
+    print("Loading tools...")
+    tools = load_tools(OPENAPI_BASE)
     print(f"Loaded {len(tools)} tools\n")
     
     # Agent erstellen
@@ -251,12 +328,19 @@ if __name__ == "__main__":
         print("=" * 60)
         
         try:
-            result = agent(user_request=t)
-            print_trajectory(result)
-            print(f"\n=> Final Answer: {result.final_answer}")
+            # Events live ausgeben, sobald sie entstehen
+            async for event in stream_many(agent, t):
+                print_event(event)
         except Exception as e:
             import traceback
             print(f"\nError: {e}")
             traceback.print_exc()
         
         print("-" * 60 + "\n")
+
+    # Keep-Alive-Verbindungen des Pools sauber schließen
+    await _client.aclose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
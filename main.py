@@ -1,21 +1,113 @@
 # main.py
-# pip install fastapi uvicorn pydantic
+# pip install fastapi uvicorn pydantic orjson
 
+import asyncio
+import itertools
 import json
+import os
 import time
-import uuid
+import unicodedata
+from collections import deque
+from contextlib import asynccontextmanager
 from pathlib import Path
-from typing import Literal, Optional, List, Dict, Any, Union
+from typing import Literal, Optional, List, Dict, Any, Union, BinaryIO, Deque
 
-from fastapi import FastAPI, Header, Request
-from pydantic import BaseModel, Field
+import orjson
+from fastapi import Depends, FastAPI, Header, Request, Response
+from fastapi.exception_handlers import request_validation_exception_handler
+from fastapi.exceptions import RequestValidationError
+from pydantic import BaseModel, Field, ValidationError
 
 LOG_PATH = Path("tool_calls.jsonl")
+LOG_DRAIN_INTERVAL_S = 0.05
+
+
+# -----------------------------
+# Trace ids: process prefix + counter (unique per deployment, no urandom syscall per request)
+# -----------------------------
+_TRACE_PREFIX = f"{os.getpid():x}-{int(time.time()):x}-"
+_trace_counter = itertools.count(1)
+
+
+def _new_trace_id() -> str:
+    return f"{_TRACE_PREFIX}{next(_trace_counter):x}"
+
+
+# -----------------------------
+# Deferred JSONL logging
+# Requests only append log entries to a deque; a background task drains it every
+# LOG_DRAIN_INTERVAL_S and writes the batch with a single write + flush, so no file
+# I/O (or JSON encoding) happens on the request path.
+# -----------------------------
+_log_q: Deque[dict] = deque()
+_log_fh: Optional[BinaryIO] = None  # opened once in lifespan
+
+
+def log_jsonl(obj: dict) -> None:
+    _log_q.append(obj)
+
+
+def _to_jsonable(obj: Any) -> Any:
+    if isinstance(obj, BaseModel):
+        return obj.model_dump(mode="json", exclude_unset=True)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def _encode_log_entry(obj: dict) -> bytes:
+    try:
+        return orjson.dumps(obj, default=_to_jsonable)
+    except TypeError:
+        # e.g. ints beyond 64 bit in a rejected body (parsed by the json module) -> one
+        # bad entry must not kill the drainer task
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":"), default=str).encode()
+
+
+def _drain_log_q() -> bytes:
+    entries = []
+    while _log_q:
+        entries.append(_log_q.popleft())
+    return b"".join(_encode_log_entry(obj) + b"\n" for obj in entries)
+
+
+def _write_log_chunk(chunk: bytes) -> None:
+    _log_fh.write(chunk)
+    _log_fh.flush()
+
+
+async def _log_drainer(stop: asyncio.Event) -> None:
+    # not cancelled on shutdown: a write running in to_thread can't be interrupted,
+    # so the drainer finishes it and returns only once stop is set and the queue
+    # is empty (entries logged during the last write are drained as well)
+    while True:
+        try:
+            await asyncio.wait_for(stop.wait(), LOG_DRAIN_INTERVAL_S)  # returns at once after stop
+        except asyncio.TimeoutError:
+            pass
+        chunk = _drain_log_q()
+        if chunk:
+            await asyncio.to_thread(_write_log_chunk, chunk)
+        if stop.is_set() and not _log_q:
+            return
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global _log_fh
+    LOG_PATH.parent.mkdir(parents=True, exist_ok=True)
+    _log_fh = LOG_PATH.open("ab", buffering=1 << 16)
+    stop = asyncio.Event()
+    drainer = asyncio.create_task(_log_drainer(stop))
+    yield
+    stop.set()
+    await drainer
+    _log_fh.close()
+
 
 app = FastAPI(
     title="Resolver + Shipping Tools",
     version="0.2.0",
     description="Hardcoded resolver tools + shipping quote tool for agentic demos.",
+    lifespan=lifespan,
 )
 
 # -----------------------------
@@ -40,7 +132,6 @@ CITY_TO_POSTAL = {
         "berlin": "10115",
         "hamburg": "20095",
         "münchen": "80331",
-        "koeln": "50667",
         "köln": "50667",
         "frankfurt": "60311",
         "stuttgart": "70173",
@@ -59,8 +150,6 @@ CITY_TO_POSTAL = {
         "villach": "9500",
         "wels": "4600",
         "st. pölten": "3100",
-        "st poelten": "3100",
-        
     },
     "CH": {
         "zürich": "8001",
@@ -74,7 +163,6 @@ CITY_TO_POSTAL = {
         "luzern": "6003",
         "lugano": "6900",
         "st. gallen": "9000",
-        "st gallen": "9000",
     },
     "NL": {
         "amsterdam": "1012",
@@ -102,31 +190,45 @@ CITY_TO_POSTAL = {
     },
 }
 
+# Precomputed lookup tables: keys are normalized once at import time, so a
+# request needs a single normalization + hash probe. ASCII spellings
+# ("koeln", "st poelten") are derived automatically instead of being
+# maintained by hand in the tables above.
+_ASCII_FOLD = str.maketrans({"ä": "ae", "ö": "oe", "ü": "ue", "ß": "ss"})
+
+
+def _norm(s: str) -> str:
+    """NFKC + casefold, dots treated as spaces, whitespace collapsed ("St.  Pölten" -> "st pölten")."""
+    return " ".join(unicodedata.normalize("NFKC", s).casefold().replace(".", " ").split())
+
+
+def _variants(key: str) -> set:
+    k = _norm(key)
+    return {k, k.translate(_ASCII_FOLD)}
+
+
+_COUNTRY_LUT = {v: iso2 for name, iso2 in COUNTRY_ALIASES.items() for v in _variants(name)}
+_CITY_LUT = {
+    iso2: {v: postal for city, postal in cities.items() for v in _variants(city)}
+    for iso2, cities in CITY_TO_POSTAL.items()
+}
+
 
 # -----------------------------
 # Logging middleware
 # -----------------------------
-def log_jsonl(obj: dict) -> None:
-    LOG_PATH.parent.mkdir(parents=True, exist_ok=True)
-    with LOG_PATH.open("a", encoding="utf-8") as f:
-        f.write(json.dumps(obj, ensure_ascii=False) + "\n")
-
-
 @app.middleware("http")
 async def trace_and_log(request: Request, call_next):
     t0 = time.time()
-    trace_id = request.headers.get("x-trace-id") or str(uuid.uuid4())
-
-    body_bytes = await request.body()
-    body_text = body_bytes.decode("utf-8", errors="replace") if body_bytes else ""
-    try:
-        body_json = json.loads(body_text) if body_text else None
-    except Exception:
-        body_json = {"_raw": body_text[:2000]}
+    start = time.perf_counter()
+    trace_id = request.headers.get("x-trace-id") or _new_trace_id()
 
     response = await call_next(request)
-    latency_s = round(time.time() - t0, 4)
+    latency_s = round(time.perf_counter() - start, 4)
 
+    # the body is not re-read here: handlers store their already parsed payload
+    # (or the raw body if validation failed) in request.state, it is serialized
+    # later by the log writer
     log_jsonl({
         "trace_id": trace_id,
         "ts": t0,
@@ -134,16 +236,27 @@ async def trace_and_log(request: Request, call_next):
         "path": request.url.path,
         "status": response.status_code,
         "latency_s": latency_s,
-        "request_body": body_json,
+        "request_body": getattr(request.state, "request_body", None),
     })
     response.headers["x-trace-id"] = trace_id
     return response
 
 
+@app.exception_handler(RequestValidationError)
+async def log_rejected_body(request: Request, exc: RequestValidationError):
+    # endpoints with a regular FastAPI body parameter (resolve_batch) reject invalid
+    # bodies before the handler runs -> keep the body FastAPI parsed for the log
+    if getattr(request.state, "request_body", None) is None:
+        request.state.request_body = exc.body
+    return await request_validation_exception_handler(request, exc)
+
+
 # -----------------------------
 # Tool schemas
 # -----------------------------
 class ResolveCountryRequest(BaseModel):
+    """Convert a country name or alias to its ISO2 code. Do NOT call if you already have a 2-letter code like DE, FR, AT."""
+
     name: str = Field(min_length=2, description="Country name, e.g. Deutschland, Austria, Schweiz")
 
 
@@ -155,6 +268,8 @@ class ResolveCountryResponse(BaseModel):
 
 
 class ResolvePostalRequest(BaseModel):
+    """Look up the postal code of a city (mode='lookup_city', needs ISO2 country and city) or validate a postal code (mode='validate_postal')."""
+
     country: Optional[str] = Field(default=None, description="ISO2 if known")
     city: Optional[str] = Field(default=None, description="City name if given")
     value: Optional[str] = Field(default=None, description="Raw user value (city or postal), for validation")
@@ -183,6 +298,8 @@ class BatchResolveResponse(BaseModel):
 
 
 class ShippingQuoteRequest(BaseModel):
+    """Calculate the shipping price. Requires an ISO2 country code and a valid postal code; call the resolvers first if needed."""
+
     country: str = Field(min_length=2, max_length=2, description="ISO-3166-1 alpha-2 country code (e.g. 'DE', 'AT', 'FR')")
     postal_code: str = Field(min_length=3, max_length=12, description="Valid postal code for the destination")
     weight_kg: float = Field(gt=0.0, lt=50.0, description="Package weight in kilograms")
@@ -196,55 +313,123 @@ class ShippingQuoteResponse(BaseModel):
     trace_id: str
 
 
+# -----------------------------
+# Request body decoding for the hot tool endpoints:
+# pydantic-core validates the raw JSON bytes in one step instead of FastAPI's
+# json.loads -> dict -> model path. The schema is still published in OpenAPI
+# (via openapi_extra), since the agents build their tools from it.
+# -----------------------------
+def json_body(model: type[BaseModel]):
+    async def decode(request: Request) -> BaseModel:
+        body = await request.body()
+        try:
+            payload = model.model_validate_json(body)
+        except ValidationError as e:
+            # rejected tool calls are the ones worth debugging -> log the raw body
+            try:
+                request.state.request_body = orjson.loads(body)
+            except orjson.JSONDecodeError:
+                request.state.request_body = body.decode(errors="replace")
+            raise RequestValidationError([{**err, "loc": ("body", *err["loc"])} for err in e.errors(include_url=False)])
+        request.state.request_body = payload
+        return payload
+
+    return Depends(decode)
+
+
+def json_body_openapi(model: type[BaseModel]) -> dict:
+    return {"requestBody": {"required": True, "content": {"application/json": {"schema": model.model_json_schema()}}}}
+
+
+# Responses of the hot endpoints are plain dicts encoded once by orjson; returning a
+# Response skips FastAPI's response_model validation and jsonable_encoder pass.
+# The *Response models are only kept for the OpenAPI docs.
+def json_response(content: Dict[str, Any]) -> Response:
+    return Response(content=orjson.dumps(content), media_type="application/json")
+
+
 # -----------------------------
 # Tools implementation
 # -----------------------------
+def lookup_country(payload: ResolveCountryRequest, trace_id: str) -> Dict[str, Any]:
+    # already a known ISO2 code (e.g. "FR") -> nothing to resolve
+    code = payload.name.strip().upper()
+    if len(code) == 2 and code in CITY_TO_POSTAL:
+        return {"iso2": code, "confidence": 1.0, "error": None, "trace_id": trace_id}
+    iso2 = _COUNTRY_LUT.get(_norm(payload.name))
+    if iso2:
+        return {"iso2": iso2, "confidence": 1.0, "error": None, "trace_id": trace_id}
+    return {"iso2": None, "confidence": 0.0, "error": "not_found", "trace_id": trace_id}
+
+
+def lookup_postal(payload: ResolvePostalRequest, trace_id: str) -> Dict[str, Any]:
+    # mode: validate_postal -> tool must NOT guess, only validate exact postal format + known mapping optionally
+    if payload.mode == "validate_postal":
+        raw = (payload.value or "").strip()
+        # accept only digits for this demo (FR has leading 0 sometimes, still digits)
+        if raw.isdigit():
+            return {"postal_code": raw, "city": None, "error": None, "trace_id": trace_id}
+        return {"postal_code": None, "city": None, "error": "not_a_postal_code", "trace_id": trace_id}
+
+    # mode: lookup_city -> requires country+city for deterministic lookup
+    if not payload.country or not payload.city:
+        return {"postal_code": None, "city": None, "error": "missing_country_or_city", "trace_id": trace_id}
+
+    c = payload.country.strip().upper()
+    postal = _CITY_LUT.get(c, {}).get(_norm(payload.city))
+    if postal:
+        return {"postal_code": postal, "city": payload.city, "error": None, "trace_id": trace_id}
+    return {"postal_code": None, "city": None, "error": "not_found", "trace_id": trace_id}
+
+
 @app.post(
     "/v1/resolve/country",
-    response_model=ResolveCountryResponse,
+    responses={200: {"model": ResolveCountryResponse}},
     operation_id="resolve_country",
     summary="Convert country name to ISO2 code",
     description="Resolves a country name or alias (e.g. 'Deutschland', 'Germany', 'Österreich') to ISO-3166-1 alpha-2 code. Do NOT call if you already have a 2-letter code like DE, FR, AT.",
+    openapi_extra=json_body_openapi(ResolveCountryRequest),
 )
-def resolve_country(payload: ResolveCountryRequest, x_trace_id: Optional[str] = Header(default=None, alias="x-trace-id")):
-    trace_id = x_trace_id or str(uuid.uuid4())
-    key = payload.name.strip().lower()
-    iso2 = COUNTRY_ALIASES.get(key)
-    if iso2:
-        return ResolveCountryResponse(iso2=iso2, confidence=1.0, trace_id=trace_id)
-    return ResolveCountryResponse(error="not_found", confidence=0.0, trace_id=trace_id)
+async def resolve_country(payload: ResolveCountryRequest = json_body(ResolveCountryRequest), x_trace_id: Optional[str] = Header(default=None, alias="x-trace-id")):
+    return json_response(lookup_country(payload, x_trace_id or _new_trace_id()))
 
 
 @app.post(
     "/v1/resolve/postal",
-    response_model=ResolvePostalResponse,
+    responses={200: {"model": ResolvePostalResponse}},
     operation_id="resolve_postal_code",
     summary="Lookup postal code for a city or validate existing postal code",
     description="Use mode='lookup_city' with ISO2 country and city name to get postal code. Use mode='validate_postal' to check if a value is a valid postal code format.",
+    openapi_extra=json_body_openapi(ResolvePostalRequest),
 )
-def resolve_postal(payload: ResolvePostalRequest, x_trace_id: Optional[str] = Header(default=None, alias="x-trace-id")):
-    trace_id = x_trace_id or str(uuid.uuid4())
+async def resolve_postal(payload: ResolvePostalRequest = json_body(ResolvePostalRequest), x_trace_id: Optional[str] = Header(default=None, alias="x-trace-id")):
+    return json_response(lookup_postal(payload, x_trace_id or _new_trace_id()))
 
-    # mode: validate_postal -> tool must NOT guess, only validate exact postal format + known mapping optionally
-    if payload.mode == "validate_postal":
-        raw = (payload.value or "").strip()
-        # accept only digits for this demo (FR has leading 0 sometimes, still digits)
-        if raw.isdigit():
-            return ResolvePostalResponse(postal_code=raw, trace_id=trace_id)
-        return ResolvePostalResponse(error="not_a_postal_code", trace_id=trace_id)
 
-    # mode: lookup_city -> requires country+city for deterministic lookup
-    if not payload.country or not payload.city:
-        return ResolvePostalResponse(error="missing_country_or_city", trace_id=trace_id)
+@app.post(
+    "/v1/resolve/batch",
+    response_model=BatchResolveResponse,
+    operation_id="resolve_batch",
+    summary="Run several resolver lookups in one call",
+    description="Runs multiple resolve_country / resolve_postal_code lookups in a single request. Each item is {tool, args} with the same args as the single endpoints; results are returned in request order.",
+)
+async def resolve_batch(payload: BatchResolveRequest, request: Request, x_trace_id: Optional[str] = Header(default=None, alias="x-trace-id")):
+    request.state.request_body = payload
+    trace_id = x_trace_id or _new_trace_id()
+    results: List[Dict[str, Any]] = []
 
-    c = payload.country.strip().upper()
-    city = payload.city.strip().lower()
+    # dispatch locally to the single-item lookups (no extra HTTP roundtrips)
+    for item in payload.requests:
+        try:
+            if item.tool == "resolve_country":
+                res = lookup_country(ResolveCountryRequest(**item.args), trace_id)
+            else:
+                res = lookup_postal(ResolvePostalRequest(**item.args), trace_id)
+            results.append(res)
+        except ValidationError as e:
+            results.append({"error": "invalid_args", "detail": [err["msg"] for err in e.errors()], "trace_id": trace_id})
 
-    m = CITY_TO_POSTAL.get(c, {})
-    postal = m.get(city)
-    if postal:
-        return ResolvePostalResponse(postal_code=postal, city=payload.city, trace_id=trace_id)
-    return ResolvePostalResponse(error="not_found", trace_id=trace_id)
+    return BatchResolveResponse(results=results, trace_id=trace_id)
 
 
 def calc_quote(weight_kg: float, service: str) -> float:
@@ -255,12 +440,13 @@ def calc_quote(weight_kg: float, service: str) -> float:
 
 @app.post(
     "/v1/shipping/quote",
-    response_model=ShippingQuoteResponse,
+    responses={200: {"model": ShippingQuoteResponse}},
     operation_id="get_shipping_quote",
     summary="Calculate shipping quote",
     description="Calculate shipping price. Requires ISO2 country code and valid postal code. Call resolve_country and resolve_postal_code first if needed.",
+    openapi_extra=json_body_openapi(ShippingQuoteRequest),
 )
-def get_shipping_quote(payload: ShippingQuoteRequest, x_trace_id: Optional[str] = Header(default=None, alias="x-trace-id")):
-    trace_id = x_trace_id or str(uuid.uuid4())
+async def get_shipping_quote(payload: ShippingQuoteRequest = json_body(ShippingQuoteRequest), x_trace_id: Optional[str] = Header(default=None, alias="x-trace-id")):
+    trace_id = x_trace_id or _new_trace_id()
     price = calc_quote(payload.weight_kg, payload.service)
-    return ShippingQuoteResponse(price=price, service=payload.service, trace_id=trace_id)
+    return json_response({"currency": "EUR", "price": price, "service": payload.service, "trace_id": trace_id})
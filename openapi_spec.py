@@ -0,0 +1,39 @@
+# openapi_spec.py
+# Gemeinsamer OpenAPI-Spec-Cache für runner3.py und dspy_agent2.py
+import functools
+import hashlib
+import time
+from pathlib import Path
+from typing import Callable
+
+import orjson
+import requests
+
+# Lokaler Cache der OpenAPI Spec (spart HTTP-Aufruf + Parsing bei jedem Start)
+SPEC_CACHE_DIR = Path.home() / ".cache" / "dspy_tutorial"
+SPEC_CACHE_MAX_AGE_S = 300
+
+
+@functools.lru_cache(maxsize=4)
+def fetch_openapi_spec(base_url: str, http_get: Callable[..., requests.Response] = requests.get) -> dict:
+    """
+    Lade OpenAPI Spec vom Server.
+
+    Pro Prozess nur einmal je base_url; eine Datei in SPEC_CACHE_DIR, die jünger
+    als SPEC_CACHE_MAX_AGE_S ist, ersetzt den HTTP-Aufruf auch über Neustarts hinweg.
+    Reiner TTL-Cache: FastAPI liefert /openapi.json ohne ETag, eine Revalidierung gibt es nicht.
+    http_get erlaubt eine eigene Session (z.B. mit Keep-Alive zum Tool-Server).
+    """
+    cache_file = SPEC_CACHE_DIR / f"openapi-{hashlib.sha1(base_url.encode()).hexdigest()[:12]}.json"
+    try:
+        if time.time() - cache_file.stat().st_mtime < SPEC_CACHE_MAX_AGE_S:
+            return orjson.loads(cache_file.read_bytes())
+    except (OSError, orjson.JSONDecodeError):
+        pass
+
+    r = http_get(f"{base_url}/openapi.json", timeout=10)
+    r.raise_for_status()
+    spec = orjson.loads(r.content)
+    SPEC_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    cache_file.write_bytes(r.content)
+    return spec
@@ -0,0 +1,342 @@
+# runner_common.py
+# Gemeinsame Bausteine für runner2.py und runner3.py
+import dbm
+import json
+import re
+import shelve
+import threading
+import time
+from typing import Any, Dict, List, Literal, Optional, Tuple
+
+import orjson
+import requests
+from pydantic import BaseModel, Field, TypeAdapter, ValidationError
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+# =============================================================================
+# HTTP-Session (Keep-Alive-Verbindungen zur Tool-API werden wiederverwendet)
+# =============================================================================
+SESSION = requests.Session()
+_ADAPTER = HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=Retry(total=2, backoff_factor=0.1))
+SESSION.mount("http://", _ADAPTER)
+SESSION.mount("https://", _ADAPTER)
+
+
+# =============================================================================
+# JSON-Ausgabe
+# =============================================================================
+def dump_json(obj: Any, sort_keys: bool = False) -> bytes:
+    """
+    orjson, mit Fallback auf das json-Modul für Werte, die orjson ablehnt.
+
+    Werte aus LM-Ausgaben sind mit json dekodiert und können z.B. Ganzzahlen
+    jenseits von 64 Bit enthalten ("Integer exceeds 64-bit range").
+    """
+    try:
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS if sort_keys else 0)
+    except TypeError:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":"), sort_keys=sort_keys, default=str).encode()
+
+
+# =============================================================================
+# JSON-Extraktion aus LM-Ausgaben
+# =============================================================================
+_JSON_DECODER = json.JSONDecoder()
+# Nur diese Zeichen ändern den Scanner-Zustand; der Text dazwischen wird in C übersprungen
+_STRUCTURAL = re.compile(r'[{}"\\]')
+
+
+def _span_end(text: str, start: int) -> int:
+    """Ende (exklusiv) des balancierten {...}-Abschnitts ab start; len(text), wenn er nicht schließt."""
+    depth = 0
+    in_str = False
+    m = _STRUCTURAL.search(text, start)
+    while m:
+        ch = m.group()
+        pos = m.end()
+        if in_str:
+            if ch == "\\":
+                pos += 1  # maskiertes Zeichen überspringen
+            elif ch == '"':
+                in_str = False
+        elif ch == '"':
+            in_str = True
+        elif ch == "{":
+            depth += 1
+        elif ch == "}":
+            depth -= 1
+            if depth == 0:
+                return pos
+        m = _STRUCTURAL.search(text, pos)
+    return len(text)
+
+
+def extract_json_objects(text: str) -> List[dict]:
+    """
+    Extrahiere JSON-Objekte aus Text (raw_decode parst ab jeder "{" außerhalb eines Objekts).
+
+    Ein kaputtes Objekt wird als Ganzes übersprungen, wie beim JSONObjectStream:
+    verschachtelte Teile (z.B. "args") zählen nie als eigene Objekte.
+    """
+    objs = []
+    i = text.find("{")
+    while i != -1:
+        try:
+            obj, end = _JSON_DECODER.raw_decode(text, i)
+        except json.JSONDecodeError:
+            end = _span_end(text, i)
+        else:
+            objs.append(obj)
+        i = text.find("{", end)
+    return objs
+
+
+def extract_single_json_object(text: str) -> Optional[dict]:
+    """
+    Schneller Weg für den Normalfall "genau EIN JSON-Objekt".
+    Gibt None zurück, wenn der Text nicht nur aus einem Objekt besteht.
+    """
+    text = text.strip()
+    if not text.startswith("{"):
+        return None
+    try:
+        obj, end = _JSON_DECODER.raw_decode(text)
+    except json.JSONDecodeError:
+        return None
+    return obj if end == len(text) else None
+
+
+def decode_objects(spans: List[str]) -> List[dict]:
+    """Dekodiere balancierte {...}-Abschnitte eines Scanners; kaputte werden verworfen."""
+    objs = []
+    for span in spans:
+        try:
+            objs.append(orjson.loads(span))
+        except orjson.JSONDecodeError:
+            pass
+    return objs
+
+
+class JSONObjectStream:
+    """Inkrementeller Extraktor: Text-Chunks hinein, jedes Top-Level-Objekt heraus, sobald es vollständig ist."""
+
+    def __init__(self) -> None:
+        self._buf = ""
+        self._pos = 0
+        self._start: Optional[int] = None
+        self._depth = 0
+        self._in_str = False
+
+    def feed(self, chunk: str) -> List[dict]:
+        buf = self._buf + chunk
+        pos = self._pos
+        spans = []  # balancierte Objekte, dekodiert erst nach dem Scan
+
+        while True:
+            if self._start is None:
+                # Außerhalb von Objekten zählt nur "{": Fließtext (samt Anführungszeichen) per str.find überspringen
+                i = buf.find("{", pos)
+                if i == -1:
+                    pos = len(buf)
+                    break
+                self._start = i
+                self._depth = 1
+                pos = i + 1
+                continue
+
+            m = _STRUCTURAL.search(buf, pos)
+            if m is None:
+                pos = len(buf)
+                break
+            i = m.start()
+            ch = buf[i]
+            pos = i + 1
+
+            if self._in_str:
+                if ch == "\\":
+                    if i + 1 == len(buf):
+                        pos = i  # maskiertes Zeichen fehlt noch -> auf den nächsten Chunk warten
+                        break
+                    pos = i + 2
+                elif ch == '"':
+                    self._in_str = False
+            elif ch == '"':
+                self._in_str = True
+            elif ch == "{":
+                self._depth += 1
+            elif ch == "}":
+                self._depth -= 1
+                if self._depth == 0:
+                    spans.append(buf[self._start:i + 1])
+                    self._start = None
+
+        # Text verwerfen, der zu keinem Objekt mehr gehören kann
+        keep = self._start if self._start is not None else pos
+        self._buf = buf[keep:]
+        self._pos = pos - keep
+        if self._start is not None:
+            self._start = 0
+        # nur geschlossene Objekte werden dekodiert, nie halbe
+        return decode_objects(spans)
+
+
+# =============================================================================
+# ToolCall-Schema (Validatoren werden einmal beim Import gebaut)
+# =============================================================================
+class ResolverCountryArgs(BaseModel):
+    name: str = Field(min_length=2)
+
+class ResolverPostalArgs(BaseModel):
+    country: Optional[str] = None
+    city: Optional[str] = None
+    value: Optional[str] = None
+    mode: Literal["lookup_city", "validate_postal"] = "lookup_city"
+
+class QuoteArgs(BaseModel):
+    country: str = Field(min_length=2, max_length=2)
+    postal_code: str = Field(min_length=3, max_length=12)
+    weight_kg: float = Field(gt=0.0, lt=50.0)
+    service: Literal["standard", "express"] = "standard"
+
+class ToolCall(BaseModel):
+    tool_name: Literal["resolve_country", "resolve_postal_code", "get_shipping_quote"]
+    args: Dict[str, Any]
+
+
+# Pro Aufruf nur ein Dict-Lookup + validate_python
+_TOOLCALL_ADAPTER = TypeAdapter(ToolCall)
+_ARG_ADAPTERS: Dict[str, TypeAdapter] = {
+    "resolve_country": TypeAdapter(ResolverCountryArgs),
+    "resolve_postal_code": TypeAdapter(ResolverPostalArgs),
+    "get_shipping_quote": TypeAdapter(QuoteArgs),
+}
+
+
+def format_errors(errors: List[dict]) -> str:
+    """Pydantic-Fehler kompakt als 'feld: meldung; ...' (ohne Input-Echo und Doku-URLs)."""
+    return "; ".join(f"{'.'.join(map(str, e['loc']))}: {e['msg']}" for e in errors)
+
+
+def validate_toolcall(obj: dict) -> Tuple[Optional[ToolCall], str]:
+    try:
+        tc = _TOOLCALL_ADAPTER.validate_python(obj)
+        return tc, ""
+    except ValidationError as e:
+        return None, f"toolcall_schema_error: {format_errors(e.errors()[:2])}"
+
+
+def check_toolcall(obj: dict) -> Tuple[Optional[ToolCall], Optional[dict]]:
+    """Prüfe ein JSON-Objekt als Tool-Call. Gibt (call, None) oder (None, Fehler-Eintrag) zurück."""
+    tc, err = validate_toolcall(obj)
+    if tc is None:
+        return None, {"error": err, "raw_obj": obj}
+
+    adapter = _ARG_ADAPTERS.get(tc.tool_name)
+    if adapter is None:
+        return None, {"error": "unknown_tool", "raw_obj": obj}
+    try:
+        adapter.validate_python(tc.args)
+    except ValidationError as e:
+        return None, {"tool": tc.tool_name, "error": e.errors()[:2], "args": tc.args}
+
+    return tc, None
+
+
+# =============================================================================
+# Tool-Ergebnis-Cache (Speicher + shelve-Datei, überlebt Neustarts)
+# =============================================================================
+# Resolver-Ergebnisse sind statisch, Quotes nur kurz gültig. Gecacht wird nur HTTP 200.
+TOOL_CACHE_TTL_S = {
+    "resolve_country": 6 * 3600,
+    "resolve_postal_code": 6 * 3600,
+    "get_shipping_quote": 60,
+}
+
+_tool_cache: Dict[str, Tuple[float, dict]] = {}
+_tool_cache_path: Optional[str] = None  # None -> nur Speicher-Cache
+_shelf_lock = threading.Lock()  # call_tool läuft auch in Worker-Threads, shelve ist nicht thread-sicher
+
+
+def use_tool_cache_file(path: str) -> None:
+    """
+    Tool-Ergebnisse zusätzlich in einer shelve-Datei ablegen (eine Datei pro Runner).
+
+    Die Datei wird nur für einzelne Lese-/Schreibzugriffe geöffnet, nie für den ganzen
+    Prozess: so blockiert ein Lauf keinen zweiten (gdbm sperrt geöffnete Dateien).
+    """
+    global _tool_cache_path
+    _tool_cache_path = path
+
+
+def _shelf_get(key: str) -> Optional[Tuple[float, dict]]:
+    if _tool_cache_path is None:
+        return None
+    with _shelf_lock:
+        try:
+            with shelve.open(_tool_cache_path, flag="r") as shelf:
+                return shelf.get(key)
+        except dbm.error:
+            return None  # Datei fehlt noch oder ist gerade von einem anderen Lauf gesperrt
+
+
+def _shelf_put(key: str, entry: Tuple[float, dict]) -> None:
+    global _tool_cache_path
+    if _tool_cache_path is None:
+        return
+    with _shelf_lock:
+        try:
+            with shelve.open(_tool_cache_path) as shelf:
+                shelf[key] = entry
+        except dbm.error as e:
+            # nicht beschreibbar -> für den Rest des Laufs nur der Speicher-Cache
+            print(f"Tool-Cache {_tool_cache_path!r} nicht nutzbar ({e}), nur Speicher-Cache")
+            _tool_cache_path = None
+
+
+def _cache_key(url: str, args: dict) -> str:
+    return f"{url}|{dump_json(args, sort_keys=True).decode()}"
+
+
+def _cache_get(key: str, ttl_s: float) -> Optional[dict]:
+    entry = _tool_cache.get(key)
+    if entry is None:
+        entry = _shelf_get(key)
+        if entry is not None:
+            _tool_cache[key] = entry
+    if entry is not None and time.time() - entry[0] < ttl_s:
+        return entry[1]
+    return None
+
+
+def _cache_put(key: str, res: dict) -> None:
+    entry = (time.time(), res)
+    _tool_cache[key] = entry
+    _shelf_put(key, entry)
+
+
+# =============================================================================
+# Tool-Ausführung
+# =============================================================================
+def call_tool(url: str, tool_name: str, args: dict, trace_id: Optional[str] = None) -> dict:
+    """POST an den Tool-Endpunkt; Ergebnis {"http": status, "json": body}, aus dem Cache wenn vorhanden."""
+    key = _cache_key(url, args)
+    ttl_s = TOOL_CACHE_TTL_S.get(tool_name)
+    if ttl_s:
+        cached = _cache_get(key, ttl_s)
+        if cached is not None:
+            return cached
+
+    headers = {"x-trace-id": trace_id} if trace_id else None
+    try:
+        r = SESSION.post(url, json=args, headers=headers, timeout=10)
+    except requests.RequestException as e:
+        return {"http": 500, "json": {"error": str(e)}}
+    try:
+        res = {"http": r.status_code, "json": orjson.loads(r.content)}
+    except orjson.JSONDecodeError:
+        return {"http": r.status_code, "json": {"error": "non-json-response", "text": r.text[:500]}}
+    if ttl_s and r.status_code == 200:
+        _cache_put(key, res)
+    return res